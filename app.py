@@ -1,15 +1,22 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import datetime
-import time
+import calendar
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
-import base64
+from firebase_admin import storage
+from google.api_core.exceptions import AlreadyExists
 from io import BytesIO
+from PIL import Image
 from openpyxl import Workbook
-from openpyxl.styles import Alignment, Font, Border, Side, PatternFill
-from openpyxl.utils import get_column_letter
+from openpyxl.styles import Alignment, Font, Border, Side, PatternFill, NamedStyle
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter, column_index_from_string
 
 # --- 設定 ---
 st.set_page_config(
@@ -23,23 +30,64 @@ st.set_page_config(
 WORK_HOURS_PER_DAY = 7.5  # 所定労働時間
 NIGHT_START_HOUR = 22     # 深夜開始
 NIGHT_END_HOUR = 5        # 深夜終了
+BATCH_WRITE_LIMIT = 500   # WriteBatch 1回あたりの最大書き込み数
+STAFF_PAGE_SIZE = 50      # スタッフ一覧の1ページあたりの表示件数
+IN_QUERY_LIMIT = 30       # in句に指定できる値の最大数
+# 勤怠の集計・表示に使うフィールド (写真URLなどは取得しない)
+ATTENDANCE_FIELDS = ['date', 'clock_in', 'clock_out', 'break_start', 'break_end']
 
 # --- データベース接続 (Firestore) ---
-if not firebase_admin._apps:
-    if "firebase" in st.secrets:
+@st.cache_resource(show_spinner=False)
+def get_db():
+    # クライアント (gRPCチャネル) は全セッション・全リランで1つを使い回す
+    if not firebase_admin._apps:
         cred_info = dict(st.secrets["firebase"])
         cred = credentials.Certificate(cred_info)
-        firebase_admin.initialize_app(cred)
-    else:
-        st.error("【重要】Firebase認証情報が設定されていません。Streamlit Secretsを設定してください。")
-        st.stop()
+        bucket_name = st.secrets.get("storage_bucket", f"{cred_info.get('project_id')}.appspot.com")
+        firebase_admin.initialize_app(cred, {'storageBucket': bucket_name})
+    return firestore.client()
+
+if not firebase_admin._apps and "firebase" not in st.secrets:
+    st.error("【重要】Firebase認証情報が設定されていません。Streamlit Secretsを設定してください。")
+    st.stop()
+
+db = get_db()
 
-db = firestore.client()
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    # Firestoreへの独立したリクエストを並列実行するためのスレッドプール
+    return ThreadPoolExecutor(max_workers=8)
 
 # --- ユーティリティ ---
 import hashlib
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+import hmac
+import os
+SCRYPT_PARAMS = {'n': 2**14, 'r': 8, 'p': 1}
+# 存在しない管理者IDでも同じ計算を行うためのダミー (どのパスワードとも一致しない)
+DUMMY_PASSWORD_RECORD = {'password': '00' * 16 + ':' + '00' * 64}
+
+def hash_password(password, salt):
+    # キャッシュしないこと: ダミーレコードの判定が速くなり、存在しない管理者IDが時間差で分かってしまう
+    return hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), **SCRYPT_PARAMS).hex()
+
+def make_password_record(password):
+    # 管理者ごとにランダムなソルトを発行し、"ソルト:ハッシュ" の形式で保存する
+    salt = os.urandom(16).hex()
+    return {'password': f"{salt}:{hash_password(password, salt)}"}
+
+def verify_password(admin_data, password):
+    stored = admin_data['password']
+    if ':' in stored:
+        salt, hashed = stored.split(':', 1)
+        return hmac.compare_digest(hashed, hash_password(password, salt))
+    # 旧形式のデータ (ソルトなしSHA-256)。ログイン成功時にscryptへ置き換える
+    # 旧形式だけ応答が速いとIDの有無が分かるため、scryptと同じ計算量を先にかける
+    hash_password(password, DUMMY_PASSWORD_RECORD['password'].split(':', 1)[0])
+    hashed = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(stored, hashed)
+
+def needs_rehash(admin_data):
+    return ':' not in admin_data['password']
 
 def get_current_time_str():
     return datetime.datetime.now().strftime("%H:%M")
@@ -47,87 +95,142 @@ def get_current_time_str():
 def get_today_str():
     return datetime.date.today().strftime("%Y-%m-%d")
 
+def get_month_range(date):
+    # 指定日を含む月の初日と末日
+    start = date.replace(day=1)
+    return start, start.replace(day=calendar.monthrange(start.year, start.month)[1])
+
 # --- 時間計算ロジック ---
-def calculate_work_stats(clock_in, clock_out, break_start=None, break_end=None):
-    if not clock_in or not clock_out:
-        return 0.0, 0.0, 0.0
-    
-    fmt = "%H:%M"
-    base_date = datetime.datetime.today().date()
+def parse_hm(s):
+    # "HH:MM" 形式の文字列を time に変換する (strptimeより高速)
+    h, m = s.split(':')
+    return datetime.time(int(h), int(m))
+
+def _hm_to_minutes(s):
+    # "HH:MM" を0時からの分数に変換する。空・不正な値は -1
+    if type(s) is str and len(s) == 5 and s[2] == ':':
+        # 固定長の "HH:MM" は文字コードから直接計算する
+        h1, h2, m1, m2 = ord(s[0]) - 48, ord(s[1]) - 48, ord(s[3]) - 48, ord(s[4]) - 48
+        if 0 <= h1 <= 9 and 0 <= h2 <= 9 and 0 <= m1 <= 5 and 0 <= m2 <= 9:
+            h = h1 * 10 + h2
+            if h < 24:
+                return h * 60 + m1 * 10 + m2
     try:
-        t_in = datetime.datetime.strptime(clock_in, fmt).replace(year=base_date.year, month=base_date.month, day=base_date.day)
-        t_out = datetime.datetime.strptime(clock_out, fmt).replace(year=base_date.year, month=base_date.month, day=base_date.day)
-    except ValueError:
-        return 0.0, 0.0, 0.0
-
-    if t_out < t_in:
-        t_out += datetime.timedelta(days=1) # 日跨ぎ
-        
-    break_hours = 0.0
-    if break_start and break_end:
-        try:
-            b_in = datetime.datetime.strptime(break_start, fmt).replace(year=base_date.year, month=base_date.month, day=base_date.day)
-            b_out = datetime.datetime.strptime(break_end, fmt).replace(year=base_date.year, month=base_date.month, day=base_date.day)
-            if b_out < b_in:
-                b_out += datetime.timedelta(days=1)
-            break_hours = (b_out - b_in).total_seconds() / 3600
-        except ValueError:
-            pass
-    
-    total_duration = (t_out - t_in).total_seconds() / 3600
-    net_work_hours = max(0.0, total_duration - break_hours)
-    overtime_hours = max(0.0, net_work_hours - WORK_HOURS_PER_DAY)
-    
-    # 深夜時間判定 (簡易)
-    night_minutes = 0
-    current = t_in
-    while current < t_out:
-        h = current.hour
-        if h >= NIGHT_START_HOUR or h < NIGHT_END_HOUR:
-            night_minutes += 1
-        current += datetime.timedelta(minutes=1)
-    
-    night_hours = night_minutes / 60.0
-    return net_work_hours, overtime_hours, night_hours
+        t = parse_hm(s)
+    except (ValueError, TypeError, AttributeError):
+        return -1
+    return t.hour * 60 + t.minute
+
+def calc_batch(records):
+    # 勤怠レコードの (実働, 残業, 深夜) をまとめて計算し、時間単位の配列で返す
+    # 休憩は開始・終了が揃っている場合のみ差し引き、日跨ぎは翌日として扱う
+    in_m = np.fromiter((_hm_to_minutes(r.get('clock_in')) for r in records), dtype=np.int32, count=len(records))
+    out_m = np.fromiter((_hm_to_minutes(r.get('clock_out')) for r in records), dtype=np.int32, count=len(records))
+    b_in = np.fromiter((_hm_to_minutes(r.get('break_start')) for r in records), dtype=np.int32, count=len(records))
+    b_out = np.fromiter((_hm_to_minutes(r.get('break_end')) for r in records), dtype=np.int32, count=len(records))
+
+    valid = (in_m >= 0) & (out_m >= 0)
+    out_m = out_m + (out_m < in_m) * 1440 # 日跨ぎ
+    b_valid = (b_in >= 0) & (b_out >= 0)
+    b_out = b_out + (b_out < b_in) * 1440
+    break_m = np.where(b_valid, b_out - b_in, 0)
+
+    net_m = np.where(valid, np.maximum(0, out_m - in_m - break_m), 0)
+    over_m = np.maximum(0, net_m - WORK_HOURS_PER_DAY * 60)
+    # 前日・当日・翌日の深夜帯 (22:00〜翌5:00) との重なり
+    night_len = (24 - NIGHT_START_HOUR + NIGHT_END_HOUR) * 60
+    night_m = np.zeros(len(records), dtype=np.int32)
+    for offset in (-1440, 0, 1440):
+        night_start = offset + NIGHT_START_HOUR * 60
+        night_m += np.clip(np.minimum(out_m, night_start + night_len) - np.maximum(in_m, night_start), 0, None)
+    night_m = np.where(valid, night_m, 0)
+    return net_m / 60.0, over_m / 60.0, night_m / 60.0
+
+# 0:00〜48:00 の表示文字列を分単位で事前に作っておく
+HM_LABELS = [f"{m // 60:02}:{m % 60:02}" for m in range(48 * 60 + 1)]
+
+def format_minutes(m):
+    # 分 (整数) を "HH:MM" に変換する。0以下は空欄
+    if m <= 0:
+        return ""
+    return HM_LABELS[m] if m < len(HM_LABELS) else f"{m // 60:02}:{m % 60:02}"
 
 def format_hour(val):
-    if val is None or val == 0:
+    if val is None or val != val:
         return ""
-    hours = int(val)
-    minutes = int((val - hours) * 60)
-    return f"{hours:02}:{minutes:02}"
+    return format_minutes(int(round(val * 60)))
 
 # --- データベース操作関数 ---
+@st.cache_resource(show_spinner=False)
+def get_employee_store():
+    # employeesコレクションを購読し、最新の内容を全セッション共通でメモリに保持する
+    store = {'by_id': {}, 'by_name': {}, 'version': 0, 'cond': threading.Condition()}
+
+    def on_snapshot(col_snapshot, changes, read_time):
+        by_id = {}
+        for doc in col_snapshot:
+            data = doc.to_dict()
+            data['id'] = doc.id
+            by_id[doc.id] = data
+        # 名前 -> 従業員データ の索引もスナップショットごとに作り直す
+        by_name = {data['name']: data for data in by_id.values() if data.get('name')}
+        with store['cond']:
+            store['by_id'] = by_id
+            store['by_name'] = by_name
+            store['version'] += 1
+            store['cond'].notify_all()
+
+    store['watch'] = db.collection('employees').on_snapshot(on_snapshot)
+    with store['cond']:
+        store['cond'].wait_for(lambda: store['version'] > 0, timeout=10)
+    return store
+
+def get_employee_version():
+    return get_employee_store()['version']
+
+def wait_for_employee_update(version, timeout=5):
+    # 書き込み後、リスナーに変更が届くまで待つ
+    store = get_employee_store()
+    with store['cond']:
+        store['cond'].wait_for(lambda: store['version'] > version, timeout=timeout)
+
 def get_employee(name):
-    docs = db.collection('employees').where('name', '==', name).stream()
-    for doc in docs:
-        data = doc.to_dict()
-        data['id'] = doc.id
-        return data
-    return None
+    return get_employees_by_name().get(name)
 
-def get_employee_by_id(doc_id):
-    if not doc_id: return None
-    doc = db.collection('employees').document(doc_id).get()
-    if doc.exists:
-        data = doc.to_dict()
-        data['id'] = doc.id
-        return data
-    return None
+def get_employees_by_name():
+    # リスナーが保持している 名前 -> 従業員データ の辞書 (呼び出し側で変更しないこと)
+    return get_employee_store()['by_name']
+
+def get_employees_by_id():
+    # リスナーが保持している id -> 従業員データ の辞書をそのまま返す (呼び出し側で変更しないこと)
+    return get_employee_store()['by_id']
 
 def get_all_employees():
-    docs = db.collection('employees').stream()
-    employees = []
+    return list(get_employees_by_id().values())
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def get_employee_frame(version):
+    # スタッフ一覧の表示用 (表示列 + id のみ)。versionが変わった時だけ作り直す
+    cols = ['name', 'employee_type', 'salary_type', 'id']
+    df = pd.DataFrame.from_records(get_all_employees())
+    return df[[c for c in cols if c in df.columns]]
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def get_employee_master_excel(version):
+    df = pd.DataFrame.from_records(get_all_employees())
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        valid_cols = [c for c in ['id', 'name', 'birth_date', 'employee_type', 'salary_type', 'salary', 'transportation', 'pin'] if c in df.columns]
+        df[valid_cols].to_excel(writer, sheet_name='従業員マスタ', index=False)
+    return output.getvalue()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_admin(username):
+    docs = db.collection('admins').where('username', '==', username).limit(1).get()
     for doc in docs:
         data = doc.to_dict()
         data['id'] = doc.id
-        employees.append(data)
-    return employees
-
-def get_admin(username):
-    docs = db.collection('admins').where('username', '==', username).stream()
-    for doc in docs:
-        return doc.to_dict()
+        return data
     return None
 
 def get_attendance_range(employee_id, start_date, end_date):
@@ -135,6 +238,7 @@ def get_attendance_range(employee_id, start_date, end_date):
              .where('employee_id', '==', employee_id)\
              .where('date', '>=', str(start_date))\
              .where('date', '<=', str(end_date))\
+             .select(ATTENDANCE_FIELDS)\
              .stream()
     data_list = []
     for doc in docs:
@@ -144,47 +248,139 @@ def get_attendance_range(employee_id, start_date, end_date):
     data_list.sort(key=lambda x: x['date'])
     return data_list
 
+def attendance_doc_id(employee_id, date_str):
+    # 勤怠は (従業員, 日付) で一意なので、ドキュメントIDを固定にして直接読み書きする
+    return f"{employee_id}_{date_str}"
+
 def get_attendance_today(employee_id, date_str):
+    doc = db.collection('attendance').document(attendance_doc_id(employee_id, date_str)).get()
+    if doc.exists:
+        data = doc.to_dict()
+        data['doc_id'] = doc.id
+        return data
+    # 自動採番IDで保存された旧データ
     docs = db.collection('attendance')\
              .where('employee_id', '==', employee_id)\
              .where('date', '==', date_str)\
-             .stream()
+             .limit(1)\
+             .get()
     for doc in docs:
         data = doc.to_dict()
         data['doc_id'] = doc.id
         return data
     return None
 
+def get_attendance_between(start_date, end_date, employee_ids=None):
+    def fetch(ids):
+        query = db.collection('attendance')
+        if ids is not None:
+            query = query.where('employee_id', 'in', ids)
+        docs = query.where('date', '>=', str(start_date))\
+                    .where('date', '<=', str(end_date))\
+                    .select(['employee_id'] + ATTENDANCE_FIELDS)\
+                    .stream()
+        return [doc.to_dict() for doc in docs]
+
+    if employee_ids is None:
+        return fetch(None)
+    # in句の上限ごとに分割し、各クエリを並列に実行する
+    chunks = [employee_ids[i:i + IN_QUERY_LIMIT] for i in range(0, len(employee_ids), IN_QUERY_LIMIT)]
+    return list(itertools.chain.from_iterable(get_executor().map(fetch, chunks)))
+
+def batch_set(collection_name, rows, merge=False):
+    # rows: (ドキュメントID, データ) のリスト。IDがNoneなら自動採番
+    # 500件ずつWriteBatchでまとめて書き込む
+    col = db.collection(collection_name)
+    for i in range(0, len(rows), BATCH_WRITE_LIMIT):
+        batch = db.batch()
+        for doc_id, data in rows[i:i + BATCH_WRITE_LIMIT]:
+            batch.set(col.document(doc_id) if doc_id else col.document(), data, merge=merge)
+        batch.commit()
+
+def compress_photo(photo, quality=80):
+    # カメラ画像をJPEGに再エンコードして容量を削減する
+    img = Image.open(photo)
+    buf = BytesIO()
+    img.convert('RGB').save(buf, format='JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+def attendance_photo_path(employee_id, date_str):
+    # 写真はFirestoreではなくCloud Storageに保存し、バケット内のパスのみを記録する
+    # (バケットは非公開のためpublic_urlは使えない。表示する場合は署名付きURLを発行する)
+    return f"attendance/{employee_id}/{date_str}.jpg"
+
+def upload_attendance_photo(doc_id, photo_path, photo):
+    # 勤怠の作成後にバックグラウンドでアップロードし、完了待ち用のFutureを返す
+    # 失敗した場合は存在しない写真を指さないよう、勤怠からパスを外す
+    data = compress_photo(photo)
+
+    def upload():
+        try:
+            storage.bucket().blob(photo_path).upload_from_string(data, content_type='image/jpeg')
+        except Exception:
+            db.collection('attendance').document(doc_id).update({'photo_path': firestore.DELETE_FIELD})
+            raise
+
+    return get_executor().submit(upload)
+
 # --- Excel生成 ---
+# 勤務表で使うスタイル (どのブックでも共通なので1回だけ作る)
+FONT_TITLE = Font(name='ＭＳ ゴシック', size=16, bold=True)
+FONT_HEADER = Font(name='ＭＳ ゴシック', size=11, bold=True)
+FONT_BODY = Font(name='ＭＳ ゴシック', size=10)
+ALIGN_CENTER = Alignment(horizontal='center', vertical='center', wrap_text=True)
+SIDE_THIN = Side(style='thin')
+BORDER_THIN = Border(left=SIDE_THIN, right=SIDE_THIN, top=SIDE_THIN, bottom=SIDE_THIN)
+FILL_HEADER = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
+
+@st.cache_data(max_entries=16, show_spinner=False)
 def generate_monthly_report_excel(employee_data, year, month, records):
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"{month}月_{employee_data['name']}"
-    
-    font_title = Font(name='ＭＳ ゴシック', size=16, bold=True)
-    font_header = Font(name='ＭＳ ゴシック', size=11, bold=True)
-    font_body = Font(name='ＭＳ ゴシック', size=10)
-    align_center = Alignment(horizontal='center', vertical='center', wrap_text=True)
-    border_thin = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-    fill_header = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
+    # write_onlyモード: セルを保持せず、行ごとにXMLへ書き出す (行は上から順に追加する)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(f"{month}月_{employee_data['name']}")
     
-    ws.merge_cells('A1:X1')
-    ws['A1'] = "【　勤　務　月　報　査　定　表　】"
-    ws['A1'].font = font_title
-    ws['A1'].alignment = align_center
-
-    ws['A3'] = f"{year}"
-    ws['C3'] = "年"
-    ws['D3'] = f"{month}"
-    ws['F3'] = "月"
-    ws['M3'] = "氏名"
-    ws['O3'] = employee_data['name']
-    ws['M4'] = "所属"
-    ws['O4'] = "ＣＨＥｚＬｅＰａｉｎ山形店" 
-    
-    for cell in ['M3', 'O3', 'M4', 'O4']:
-        ws[cell].border = border_thin
-        ws[cell].font = font_body
+    # 明細行の共通スタイルは名前付きスタイルとして1回だけ登録し、セルには名前で割り当てる
+    # (名前付きスタイルはブックに紐付くため、ブックごとに作る)
+    body_style = NamedStyle(name='body', font=FONT_BODY, alignment=ALIGN_CENTER, border=BORDER_THIN)
+    wb.add_named_style(body_style)
+
+    def make_cell(value=None, font=None, alignment=None, border=None, fill=None, style=None):
+        cell = WriteOnlyCell(ws, value=value)
+        if style: cell.style = style
+        if font: cell.font = font
+        if alignment: cell.alignment = alignment
+        if border: cell.border = border
+        if fill: cell.fill = fill
+        return cell
+
+    def make_row(cells):
+        # {列文字: セル} の辞書から、空き列を None で埋めた1行分のリストを作る
+        row = [None] * max(column_index_from_string(c) for c in cells)
+        for col, cell in cells.items():
+            row[column_index_from_string(col) - 1] = cell
+        return row
+
+    # 列幅は行を書き込む前に設定する必要がある
+    ws.column_dimensions['A'].width = 5
+    ws.column_dimensions['B'].width = 5
+    for c in ['C','D','E','F','G','H','I','J','K']:
+         ws.column_dimensions[c].width = 10
+
+    ws.merged_cells.add('A1:X1')
+    ws.append([make_cell("【　勤　務　月　報　査　定　表　】", font=FONT_TITLE, alignment=ALIGN_CENTER)])
+    ws.append([])
+
+    ws.append(make_row({
+        'A': make_cell(f"{year}"), 'C': make_cell("年"), 'D': make_cell(f"{month}"), 'F': make_cell("月"),
+        'M': make_cell("氏名", font=FONT_BODY, border=BORDER_THIN),
+        'O': make_cell(employee_data['name'], font=FONT_BODY, border=BORDER_THIN),
+    }))
+    ws.append(make_row({
+        'M': make_cell("所属", font=FONT_BODY, border=BORDER_THIN),
+        'O': make_cell("ＣＨＥｚＬｅＰａｉｎ山形店", font=FONT_BODY, border=BORDER_THIN),
+    }))
+    ws.append([])
+    ws.append([])
 
     headers_def = [
         ('A7:A8', '日付'), ('B7:B8', '曜日'), 
@@ -192,35 +388,27 @@ def generate_monthly_report_excel(employee_data, year, month, records):
         ('I7:K7', '超過勤務'), ('L7:N7', '法定内休日'), 
         ('O7:Q7', '法定外休日'), ('R7:R8', '記事'), ('S7:S8', '備考')
     ]
+    header_cells = {}
     for rng, val in headers_def:
-        ws.merge_cells(rng)
+        ws.merged_cells.add(rng)
         top_left = rng.split(':')[0]
-        cell = ws[top_left]
-        cell.value = val
-        cell.alignment = align_center
-        cell.border = border_thin
-        cell.fill = fill_header
-        cell.font = font_header
+        header_cells[top_left[0]] = make_cell(val, font=FONT_HEADER, alignment=ALIGN_CENTER, border=BORDER_THIN, fill=FILL_HEADER)
+    ws.append(make_row(header_cells))
 
     sub_headers = {
-        'C8': '始業', 'D8': '終業', 'E8': '休憩',
-        'F8': '実働', 'G8': '移動', 'H8': '時間内',
-        'I8': '残業', 'J8': '深夜', 'K8': '時間内', 
+        'C': '始業', 'D': '終業', 'E': '休憩',
+        'F': '実働', 'G': '移動', 'H': '時間内',
+        'I': '残業', 'J': '深夜', 'K': '時間内', 
     }
-    for cell_addr, val in sub_headers.items():
-        cell = ws[cell_addr]
-        cell.value = val
-        cell.alignment = align_center
-        cell.border = border_thin
-        cell.font = font_body
-
-    import calendar
-    try:
-        last_day = calendar.monthrange(year, month)[1]
-    except:
-        last_day = 30
+    ws.append(make_row({col: make_cell(val, style='body') for col, val in sub_headers.items()}))
+
+    # 1日の曜日と月末日を1回だけ求め、各日の曜日は足し算で出す
+    first_wd, last_day = calendar.monthrange(year, month)
     
     att_map = {r['date']: r for r in records}
+    att_records = list(att_map.values())
+    nets, overs, nights = calc_batch(att_records)
+    stats_map = {r['date']: (nets[i], overs[i], nights[i]) for i, r in enumerate(att_records)}
     row_idx = 9
     total_net = 0.0
     total_over = 0.0
@@ -228,56 +416,38 @@ def generate_monthly_report_excel(employee_data, year, month, records):
     weekdays_jp = ["月", "火", "水", "木", "金", "土", "日"]
     
     for day in range(1, last_day + 1):
-        date_obj = datetime.date(year, month, day)
-        date_str = date_obj.strftime("%Y-%m-%d")
-        
-        ws[f'A{row_idx}'] = day
-        ws[f'B{row_idx}'] = weekdays_jp[date_obj.weekday()]
+        date_str = f"{year:04}-{month:02}-{day:02}"
         
-        for col in range(1, 20):
-            cell = ws.cell(row=row_idx, column=col)
-            cell.border = border_thin
-            cell.alignment = align_center
-            cell.font = font_body
+        values = [None] * 19
+        values[0] = day
+        values[1] = weekdays_jp[(first_wd + day - 1) % 7]
 
         if date_str in att_map:
             d = att_map[date_str]
-            net, over, night = calculate_work_stats(
-                d.get('clock_in'), d.get('clock_out'), 
-                d.get('break_start'), d.get('break_end')
-            )
-            ws[f'C{row_idx}'] = d.get('clock_in', '')
-            ws[f'D{row_idx}'] = d.get('clock_out', '')
+            net, over, night = stats_map[date_str]
+            values[2] = d.get('clock_in', '')
+            values[3] = d.get('clock_out', '')
             if d.get('break_start'):
-                ws[f'E{row_idx}'] = f"{d.get('break_start')}~"
-            ws[f'F{row_idx}'] = format_hour(net)
-            ws[f'I{row_idx}'] = format_hour(over)
-            ws[f'J{row_idx}'] = format_hour(night)
+                values[4] = f"{d.get('break_start')}~"
+            values[5] = format_hour(net)
+            values[8] = format_hour(over)
+            values[9] = format_hour(night)
             total_net += net
             total_over += over
             total_night += night
+        ws.append([make_cell(v, style='body') for v in values])
         row_idx += 1
 
-    ws[f'A{row_idx}'] = "合　計"
-    ws.merge_cells(f'A{row_idx}:B{row_idx}')
-    cell_sum = ws[f'A{row_idx}']
-    cell_sum.alignment = align_center
-    cell_sum.border = border_thin
-    cell_sum.font = font_header
-    ws[f'F{row_idx}'] = format_hour(total_net)
-    ws[f'I{row_idx}'] = format_hour(total_over)
-    ws[f'J{row_idx}'] = format_hour(total_night)
+    ws.merged_cells.add(f'A{row_idx}:B{row_idx}')
+    total_values = {'F': format_hour(total_net), 'I': format_hour(total_over), 'J': format_hour(total_night)}
+    total_row = [make_cell("合　計", font=FONT_HEADER, alignment=ALIGN_CENTER, border=BORDER_THIN), None]
     for col in range(3, 20):
-        cell = ws.cell(row=row_idx, column=col)
-        cell.border = border_thin
-        cell.font = font_body
-
-    ws.column_dimensions['A'].width = 5
-    ws.column_dimensions['B'].width = 5
-    for c in ['C','D','E','F','G','H','I','J','K']:
-         ws.column_dimensions[c].width = 10
+        total_row.append(make_cell(total_values.get(get_column_letter(col)), font=FONT_BODY, border=BORDER_THIN))
+    ws.append(total_row)
     
-    return wb
+    out = BytesIO()
+    wb.save(out)
+    return out.getvalue()
 
 # --- UIスタイル ---
 def style_setup():
@@ -303,24 +473,27 @@ def style_setup():
 # --- 画面: 認証 ---
 def login_screen():
     st.title("勤怠管理アプリ 🍩")
-    admins = db.collection('admins').limit(1).stream()
-    if not list(admins):
+    # 管理者の存在確認はセッションごとに1回だけ行う (ドキュメントIDのみ取得)
+    if 'admin_exists' not in st.session_state:
+        admins = db.collection('admins').select([firestore.FieldPath.document_id()]).limit(1).stream()
+        st.session_state['admin_exists'] = any(True for _ in admins)
+    if not st.session_state['admin_exists']:
         st.warning("管理者が登録されていません。")
         if st.button("初期管理者作成"):
-            hashed = hash_password("password")
-            db.collection('admins').add({"username": "admin", "password": hashed})
-            st.success("作成しました。")
-            time.sleep(2)
+            db.collection('admins').add({"username": "admin", **make_password_record("password")})
+            get_admin.clear()
+            st.session_state['admin_exists'] = True
+            st.toast("作成しました。")
             st.rerun()
 
     tab1, tab2 = st.tabs(["🐣 スタッフ", "🔧 管理者"])
     with tab1:
         st.header("さあ、はじめましょう！")
-        employees = get_all_employees()
-        if not employees:
+        emp_by_name = get_employees_by_name()
+        if not emp_by_name:
             st.info("スタッフが登録されていません。")
         else:
-            emp_names = [e['name'] for e in employees]
+            emp_names = list(emp_by_name.keys())
             selected_name = st.selectbox("お名前を選んでください", emp_names)
             pin = st.text_input("暗証番号 (4桁)", type="password", key="staff_pin", max_chars=4)
             c1, c2, c3 = st.columns([1, 2, 1])
@@ -332,6 +505,7 @@ def login_screen():
                         st.session_state['user_role'] = 'staff'
                         st.session_state['user_id'] = emp_data['id']
                         st.session_state['user_name'] = selected_name
+                        st.session_state['employee'] = emp_data
                         st.rerun()
                     else:
                         st.error("暗証番号が違います🥺")
@@ -343,7 +517,12 @@ def login_screen():
         with c2:
             if st.button("ログイン", key="admin_login_btn"):
                 admin_data = get_admin(admin_user)
-                if admin_data and admin_data['password'] == hash_password(admin_pass):
+                # IDの有無で応答時間が変わらないよう、常にハッシュを計算して比較する
+                password_ok = verify_password(admin_data or DUMMY_PASSWORD_RECORD, admin_pass)
+                if admin_data and password_ok:
+                    if needs_rehash(admin_data):
+                        db.collection('admins').document(admin_data['id']).update(make_password_record(admin_pass))
+                        get_admin.clear()
                     st.session_state['logged_in'] = True
                     st.session_state['user_role'] = 'admin'
                     st.session_state['user_name'] = admin_user
@@ -352,10 +531,57 @@ def login_screen():
                     st.error("IDまたはパスワードが違います")
 
 # --- 画面: スタッフ機能 ---
+def track_pending_write(future, message="打刻の保存に失敗しました。もう一度お試しください。"):
+    st.session_state.setdefault('pending_writes', []).append((future, message))
+
+def check_pending_writes():
+    # 完了した書き込みの失敗を表示する。失敗が無ければ True
+    ok = True
+    pending = []
+    for future, message in st.session_state.get('pending_writes', []):
+        if not future.done():
+            pending.append((future, message))
+        elif future.exception():
+            ok = False
+            st.error(f"{message}({future.exception()})")
+            # 画面に先に反映した内容を破棄してFirestoreから取り直す
+            st.session_state.pop('month_logs_date', None)
+    st.session_state['pending_writes'] = pending
+    return ok
+
+def flush_pending_writes(timeout=10):
+    # ログアウト前に未完了の書き込みを待ち、全て保存できたかを返す
+    wait([future for future, _ in st.session_state.get('pending_writes', [])], timeout=timeout)
+    ok = check_pending_writes()
+    if st.session_state['pending_writes']:
+        st.warning("保存中の打刻があります。少し待ってからもう一度ログアウトしてください。")
+        return False
+    return ok
+
+def update_attendance_optimistic(record, fields):
+    record.update(fields)
+    prior = [future for future, _ in st.session_state.get('pending_writes', [])]
+    ref = db.collection('attendance').document(record['doc_id'])
+
+    def write():
+        # 書き込みの順序が入れ替わらないよう、先行する書き込みを待つ
+        wait(prior)
+        ref.update(fields)
+
+    track_pending_write(get_executor().submit(write))
+
 def staff_dashboard():
     st.title(f"お疲れ様です、{st.session_state['user_name']}さん ✨")
     today = get_today_str()
-    record = get_attendance_today(st.session_state['user_id'], today)
+    month_start, month_end = get_month_range(datetime.date.today())
+    # 前回の打刻の書き込み結果を確認する
+    check_pending_writes()
+    # 今日の打刻と今月の実績を1回のクエリで取得し、以降はセッション上の値を更新して使う
+    if st.session_state.get('month_logs_date') != today:
+        st.session_state['month_logs'] = get_attendance_range(st.session_state['user_id'], month_start, month_end)
+        st.session_state['month_logs_date'] = today
+    logs = st.session_state['month_logs']
+    record = next((r for r in logs if r['date'] == today), None)
     
     # 【修正箇所】recordがNoneの場合の対策
     clock_in = record.get('clock_in') if record else None
@@ -370,31 +596,47 @@ def staff_dashboard():
     c2.metric("退勤時刻", clock_out if clock_out else "--:--")
     st.write("") 
 
-    photo = st.camera_input("認証用写真撮影", label_visibility="collapsed")
-    photo_b64 = None
-    if photo:
-        photo_b64 = base64.b64encode(photo.getvalue()).decode()
+    # 写真は出勤時のみ使うため、出勤済みならカメラを表示しない
+    photo = None
+    if not clock_in:
+        photo = st.camera_input("認証用写真撮影", label_visibility="collapsed")
     st.write("")
 
+    # 出勤は保存の完了を待って確定し、以降の打刻は画面に先に反映してバックグラウンドで書き込む
     col1, col2 = st.columns(2)
     col3, col4 = st.columns(2)
     with col1:
         if st.button("☀️ 出勤"):
-            if not photo_b64:
-                st.warning("写真を撮影してください📸")
-            elif clock_in:
+            if clock_in:
                 st.warning("すでに出勤しています")
+            elif not photo:
+                st.warning("写真を撮影してください📸")
             else:
-                db.collection('attendance').add({
+                doc_id = attendance_doc_id(st.session_state['user_id'], today)
+                photo_path = attendance_photo_path(st.session_state['user_id'], today)
+                data = {
                     'employee_id': st.session_state['user_id'],
                     'date': today,
                     'clock_in': get_current_time_str(),
-                    'photo': photo_b64,
-                    'created_at': firestore.SERVER_TIMESTAMP
-                })
-                st.success("おはようございます！今日も頑張りましょう！🌈")
-                time.sleep(2)
-                st.rerun()
+                    'photo_path': photo_path,
+                }
+                # 管理者が先に登録した記録を上書きしないよう create で作成する
+                # 写真は同名で上書きしないよう、作成に成功してからアップロードする
+                try:
+                    db.collection('attendance').document(doc_id).create({**data, 'created_at': firestore.SERVER_TIMESTAMP})
+                except AlreadyExists:
+                    st.error("本日の勤怠はすでに登録されています。画面を更新すると最新の内容が表示されます。")
+                    st.session_state.pop('month_logs_date', None)
+                except Exception as e:
+                    st.error(f"打刻の保存に失敗しました。もう一度お試しください。({e})")
+                else:
+                    logs.append({**data, 'doc_id': doc_id})
+                    track_pending_write(
+                        upload_attendance_photo(doc_id, photo_path, photo),
+                        "出勤は記録されましたが、写真の保存に失敗しました。"
+                    )
+                    st.toast("おはようございます！今日も頑張りましょう！🌈")
+                    st.rerun()
     with col2:
         if st.button("🌙 退勤"):
             if not clock_in:
@@ -403,43 +645,28 @@ def staff_dashboard():
                 st.warning("すでに退勤しています")
             else:
                 if doc_id:
-                    db.collection('attendance').document(doc_id).update({'clock_out': get_current_time_str()})
-                    st.success("お疲れ様でした！ゆっくり休んでください🍵")
-                    time.sleep(2)
+                    update_attendance_optimistic(record, {'clock_out': get_current_time_str()})
+                    st.toast("お疲れ様でした！ゆっくり休んでください🍵")
                     st.rerun()
     with col3:
         if st.button("☕️ 休憩"):
             if doc_id and not break_start:
-                db.collection('attendance').document(doc_id).update({'break_start': get_current_time_str()})
+                update_attendance_optimistic(record, {'break_start': get_current_time_str()})
                 st.rerun()
             else:
                 st.warning("操作できません")
     with col4:
         if st.button("💪 再開"):
             if doc_id and break_start and not break_end:
-                db.collection('attendance').document(doc_id).update({'break_end': get_current_time_str()})
+                update_attendance_optimistic(record, {'break_end': get_current_time_str()})
                 st.rerun()
             else:
                 st.warning("操作できません")
     st.divider()
 
     with st.expander("💰 今月の概算給与"):
-        emp = get_employee_by_id(st.session_state['user_id'])
-        current_month = datetime.datetime.now().strftime("%Y-%m")
-        start_m = current_month + "-01"
-        end_m = current_month + "-31"
-        
-        logs = db.collection('attendance')\
-                 .where('employee_id', '==', st.session_state['user_id'])\
-                 .where('date', '>=', start_m)\
-                 .where('date', '<=', end_m)\
-                 .stream()
-        
-        work_hours = 0.0
-        for log in logs:
-            d = log.to_dict()
-            net, _, _ = calculate_work_stats(d.get('clock_in'), d.get('clock_out'), d.get('break_start'), d.get('break_end'))
-            work_hours += net
+        emp = st.session_state.get('employee')
+        work_hours = float(calc_batch(logs)[0].sum())
         
         est_pay = 0
         if emp and emp.get('salary_type') == '月給':
@@ -471,30 +698,76 @@ def admin_dashboard():
             trans = c6.number_input("交通費", min_value=0)
             pin = st.text_input("暗証番号 (4桁)", max_chars=4)
             if st.form_submit_button("登録"):
+                version = get_employee_version()
                 db.collection('employees').add({
-                    'name': name, 'birth_date': str(birth), 'employee_type': e_type,
+                    'name': name, 'birth_date': birth.isoformat(), 'employee_type': e_type,
                     'salary_type': s_type, 'salary': salary, 'transportation': trans,
                     'pin': pin, 'created_at': firestore.SERVER_TIMESTAMP
                 })
-                st.success("登録しました")
-                time.sleep(1)
+                wait_for_employee_update(version)
+                st.toast("登録しました")
                 st.rerun()
+        with st.expander("スタッフ一括登録"):
+            bulk_df = st.data_editor(
+                pd.DataFrame(columns=['name', 'birth_date', 'employee_type', 'salary_type', 'salary', 'transportation', 'pin']),
+                num_rows="dynamic",
+                column_config={
+                    'name': st.column_config.TextColumn("氏名"),
+                    'birth_date': st.column_config.DateColumn("生年月日", min_value=datetime.date(1960, 1, 1)),
+                    'employee_type': st.column_config.SelectboxColumn("雇用形態", options=["社員", "AP"], default="AP"),
+                    'salary_type': st.column_config.SelectboxColumn("給与形態", options=["月給", "時給"], default="時給"),
+                    'salary': st.column_config.NumberColumn("給与額", min_value=0, default=0),
+                    'transportation': st.column_config.NumberColumn("交通費", min_value=0, default=0),
+                    'pin': st.column_config.TextColumn("暗証番号 (4桁)", max_chars=4),
+                },
+                # 登録後はキーを変えて編集内容を破棄する (再クリックでの二重登録防止)
+                key=f"bulk_emp_{st.session_state.get('bulk_emp_rev', 0)}",
+            )
+            if st.button("一括登録"):
+                rows = []
+                for r in bulk_df.to_dict('records'):
+                    if not r.get('name'):
+                        continue
+                    # 空のDataFrameから作った列は、日付がISO文字列のまま返ってくるため正規化する
+                    birth = r.get('birth_date')
+                    birth_str = pd.Timestamp(birth).date().isoformat() if pd.notna(birth) and birth != '' else ''
+                    rows.append({
+                        'name': r['name'], 'birth_date': birth_str,
+                        'employee_type': r.get('employee_type') or "AP", 'salary_type': r.get('salary_type') or "時給",
+                        'salary': int(r.get('salary') or 0), 'transportation': int(r.get('transportation') or 0),
+                        'pin': r.get('pin') or '', 'created_at': firestore.SERVER_TIMESTAMP
+                    })
+                if rows:
+                    version = get_employee_version()
+                    batch_set('employees', [(None, r) for r in rows])
+                    wait_for_employee_update(version)
+                    st.session_state['bulk_emp_rev'] = st.session_state.get('bulk_emp_rev', 0) + 1
+                    st.toast(f"{len(rows)}名を登録しました")
+                    st.rerun()
+                else:
+                    st.warning("登録するスタッフを入力してください")
         st.subheader("登録済みスタッフ")
-        emps = get_all_employees()
-        if emps:
-            df = pd.DataFrame(emps)
-            st.dataframe(df[['name', 'employee_type', 'salary_type', 'id']])
-            output_emp = BytesIO()
-            with pd.ExcelWriter(output_emp, engine='openpyxl') as writer:
-                valid_cols = [c for c in ['id', 'name', 'birth_date', 'employee_type', 'salary_type', 'salary', 'transportation', 'pin'] if c in df.columns]
-                df[valid_cols].to_excel(writer, sheet_name='従業員マスタ', index=False)
-            output_emp.seek(0)
-            st.download_button("従業員マスタ Excel出力", data=output_emp, file_name="employee_master.xlsx")
-            del_id = st.selectbox("削除対象ID", [e['id'] for e in emps])
+        version = get_employee_version()
+        df = get_employee_frame(version)
+        if not df.empty:
+            last_page = (len(df) - 1) // STAFF_PAGE_SIZE
+            page = min(st.session_state.get('emp_page', 0), last_page)
+            st.dataframe(df.iloc[page * STAFF_PAGE_SIZE:(page + 1) * STAFF_PAGE_SIZE])
+            if last_page > 0:
+                p1, p2, p3 = st.columns([1, 2, 1])
+                if p1.button(f"前の{STAFF_PAGE_SIZE}件", disabled=page == 0):
+                    st.session_state['emp_page'] = page - 1
+                    st.rerun()
+                p2.caption(f"{page + 1} / {last_page + 1} ページ (全{len(df)}名)")
+                if p3.button(f"次の{STAFF_PAGE_SIZE}件", disabled=page == last_page):
+                    st.session_state['emp_page'] = page + 1
+                    st.rerun()
+            st.download_button("従業員マスタ Excel出力", data=get_employee_master_excel(version), file_name="employee_master.xlsx")
+            del_id = st.selectbox("削除対象ID", df['id'].tolist())
             if st.button("選択したスタッフを削除"):
                 db.collection('employees').document(del_id).delete()
-                st.warning("削除しました")
-                time.sleep(1)
+                wait_for_employee_update(version)
+                st.toast("削除しました")
                 st.rerun()
 
     elif menu == "👤 個人実績・出力":
@@ -508,22 +781,18 @@ def admin_dashboard():
             today = datetime.date.today()
             sel_month = c2.date_input("対象年月", value=today)
             
-            import calendar
-            start_date = sel_month.replace(day=1)
-            last_day = calendar.monthrange(start_date.year, start_date.month)[1]
-            end_date = start_date.replace(day=last_day)
+            start_date, end_date = get_month_range(sel_month)
             records = get_attendance_range(target_emp['id'], start_date, end_date)
             
             st.markdown(f"**{sel_name}** さんの **{start_date.year}年{start_date.month}月** の実績")
             prev_data = []
-            total_net = 0.0
-            for d in records:
-                net, over, night = calculate_work_stats(d.get('clock_in'), d.get('clock_out'), d.get('break_start'), d.get('break_end'))
+            nets, overs, nights = calc_batch(records)
+            for d, net, over, night in zip(records, nets, overs, nights):
                 prev_data.append({
                     "日付": d['date'], "出勤": d.get('clock_in'), "退勤": d.get('clock_out'),
                     "実働": format_hour(net), "残業": format_hour(over), "深夜": format_hour(night)
                 })
-                total_net += net
+            total_net = float(nets.sum())
             if prev_data:
                 st.dataframe(pd.DataFrame(prev_data))
                 st.metric("合計実労働時間", format_hour(total_net))
@@ -531,23 +800,31 @@ def admin_dashboard():
                 st.warning("データがありません")
             
             # Excel出力 (ボタン入れ子回避)
-            wb = generate_monthly_report_excel(target_emp, start_date.year, start_date.month, records)
-            out = BytesIO()
-            wb.save(out)
-            out.seek(0)
-            st.download_button(
-                label="📥 勤務表をExcelでダウンロード",
-                data=out,
-                file_name=f"勤怠管理表_{sel_name}_{start_date.month}月.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+            # 生成はボタン押下時のみ行い、結果はセッションに保持する (同じ内容ならキャッシュを使う)
+            # 勤怠の内容も鍵に含め、修正・打刻があれば古いファイルを出さない
+            records_fp = hash(tuple(sorted(tuple(r.get(f) or '' for f in ATTENDANCE_FIELDS) for r in records)))
+            report_key = (target_emp['id'], start_date.year, start_date.month, records_fp)
+            if st.button("📄 勤務表Excelを作成"):
+                st.session_state['report_xlsx'] = (
+                    report_key,
+                    generate_monthly_report_excel(target_emp, start_date.year, start_date.month, records)
+                )
+            saved = st.session_state.get('report_xlsx')
+            if saved and saved[0] == report_key:
+                st.download_button(
+                    label="📥 勤務表をExcelでダウンロード",
+                    data=saved[1],
+                    file_name=f"勤怠管理表_{sel_name}_{start_date.month}月.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
 
     elif menu == "✏️ 勤怠修正":
         st.subheader("勤怠データの修正・追加")
         emps = get_all_employees()
         if emps:
             c1, c2 = st.columns(2)
-            selected_emp_id = c1.selectbox("スタッフ選択", [e['id'] for e in emps], format_func=lambda x: next(e['name'] for e in emps if e['id'] == x))
+            name_by_id = {e['id']: e['name'] for e in emps}
+            selected_emp_id = c1.selectbox("スタッフ選択", list(name_by_id.keys()), format_func=name_by_id.get)
             selected_date = c2.date_input("日付選択", value=datetime.date.today())
             date_str = str(selected_date)
             record = get_attendance_today(selected_emp_id, date_str)
@@ -559,9 +836,9 @@ def admin_dashboard():
                 st.write("📝 データあり。修正モード")
                 doc_id = record.get('doc_id')
                 if record.get('clock_in'):
-                    def_in = datetime.datetime.strptime(record['clock_in'], "%H:%M").time()
+                    def_in = parse_hm(record['clock_in'])
                 if record.get('clock_out'):
-                    def_out = datetime.datetime.strptime(record['clock_out'], "%H:%M").time()
+                    def_out = parse_hm(record['clock_out'])
             else:
                 st.info("新規作成モード")
 
@@ -569,20 +846,46 @@ def admin_dashboard():
                 tc1, tc2 = st.columns(2)
                 new_in = tc1.time_input("出勤", value=def_in)
                 new_out = tc2.time_input("退勤", value=def_out)
-                if st.form_submit_button("保存"):
-                    data = {
-                        'clock_in': new_in.strftime("%H:%M"),
-                        'clock_out': new_out.strftime("%H:%M"),
-                        'date': date_str, 'employee_id': selected_emp_id
-                    }
+                fc1, fc2 = st.columns(2)
+                save = fc1.form_submit_button("保存")
+                add_pending = fc2.form_submit_button("一括保存リストに追加")
+                data = {
+                    'clock_in': new_in.strftime("%H:%M"),
+                    'clock_out': new_out.strftime("%H:%M"),
+                    'date': date_str, 'employee_id': selected_emp_id
+                }
+                if save:
                     if doc_id:
                         db.collection('attendance').document(doc_id).update(data)
-                        st.success("更新しました")
+                        st.toast("更新しました")
                     else:
                         data['created_at'] = firestore.SERVER_TIMESTAMP
-                        db.collection('attendance').add(data)
-                        st.success("作成しました")
-                    time.sleep(1)
+                        db.collection('attendance').document(attendance_doc_id(selected_emp_id, date_str)).set(data)
+                        st.toast("作成しました")
+                    st.rerun()
+                elif add_pending:
+                    if not doc_id:
+                        data['created_at'] = firestore.SERVER_TIMESTAMP
+                    key = doc_id or attendance_doc_id(selected_emp_id, date_str)
+                    st.session_state.setdefault('pending_edits', {})[key] = data
+                    st.rerun()
+
+            # 複数日・複数スタッフの修正をまとめてWriteBatchで保存する
+            pending_edits = st.session_state.get('pending_edits', {})
+            if pending_edits:
+                st.markdown(f"**一括保存待ち: {len(pending_edits)}件**")
+                st.dataframe(pd.DataFrame([
+                    {'名前': name_by_id.get(d['employee_id'], ''), '日付': d['date'], '出勤': d['clock_in'], '退勤': d['clock_out']}
+                    for d in pending_edits.values()
+                ]))
+                pc1, pc2 = st.columns(2)
+                if pc1.button("一括保存"):
+                    batch_set('attendance', list(pending_edits.items()), merge=True)
+                    st.session_state['pending_edits'] = {}
+                    st.toast(f"{len(pending_edits)}件を保存しました")
+                    st.rerun()
+                if pc2.button("一括保存リストを破棄"):
+                    st.session_state['pending_edits'] = {}
                     st.rerun()
 
     elif menu == "📊 全体集計":
@@ -590,34 +893,38 @@ def admin_dashboard():
         d1, d2 = st.columns(2)
         start_d = d1.date_input("開始", value=datetime.date.today().replace(day=1))
         end_d = d2.date_input("終了", value=datetime.date.today())
+        emp_map = get_employees_by_id()
+        sel_ids = st.multiselect("スタッフ (未選択の場合は全員)", list(emp_map.keys()), format_func=lambda x: emp_map[x]['name'])
         
         if st.button("一覧ダウンロード"):
-            all_logs = db.collection('attendance').stream()
+            all_logs = get_attendance_between(start_d, end_d, sel_ids or None)
             data_list = []
-            emp_map = {e['id']: e for e in get_all_employees()}
-            for doc in all_logs:
-                d = doc.to_dict()
-                try:
-                    log_date = datetime.datetime.strptime(d['date'], "%Y-%m-%d").date()
-                except (KeyError, ValueError, TypeError):
-                    continue # データ不備はスキップ
-                
-                if start_d <= log_date <= end_d:
-                    emp = emp_map.get(d.get('employee_id'))
-                    if emp:
-                        ymd = d['date'].split('-')
-                        data_list.append({
-                            '名前': emp['name'], '年': int(ymd[0]), '月': int(ymd[1]), '日': int(ymd[2]),
-                            '出勤': d.get('clock_in'), '退勤': d.get('clock_out'), '給与形態': emp.get('salary_type')
-                        })
+            for d in all_logs:
+                emp = emp_map.get(d.get('employee_id'))
+                if emp:
+                    data_list.append({
+                        '名前': emp['name'], 'date': d['date'],
+                        '出勤': d.get('clock_in'), '退勤': d.get('clock_out'), '給与形態': emp.get('salary_type')
+                    })
             if data_list:
                 df_res = pd.DataFrame(data_list)
+                # 日付は "YYYY-MM-DD" 固定なので、行ごとに分解せず列単位で切り出す
+                dates = df_res.pop('date')
+                df_res.insert(1, '年', dates.str[0:4].astype(int))
+                df_res.insert(2, '月', dates.str[5:7].astype(int))
+                df_res.insert(3, '日', dates.str[8:10].astype(int))
                 st.dataframe(df_res)
+                # write_onlyモードでセルオブジェクトを保持せずに書き出す
+                wb = Workbook(write_only=True)
+                ws = wb.create_sheet('勤怠一覧')
+                ws.append(list(df_res.columns))
+                for row in df_res.itertuples(index=False, name=None):
+                    ws.append(row)
                 output = BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    df_res.to_excel(writer, sheet_name='勤怠一覧', index=False)
+                wb.save(output)
                 output.seek(0)
                 st.download_button("Excelダウンロード", data=output, file_name="attendance_list.xlsx")
+                st.download_button("CSVダウンロード", data=df_res.to_csv(index=False).encode('utf-8-sig'), file_name="attendance_list.csv", mime="text/csv")
             else:
                 st.warning("データなし")
 
@@ -626,8 +933,11 @@ def admin_dashboard():
         new_p = st.text_input("新パスワード", type="password")
         if st.button("変更"):
             docs = db.collection('admins').where('username', '==', 'admin').stream()
+            batch = db.batch()
             for doc in docs:
-                db.collection('admins').document(doc.id).update({'password': hash_password(new_p)})
+                batch.update(doc.reference, make_password_record(new_p))
+            batch.commit()
+            get_admin.clear()
             st.success("変更しました")
 
 # --- メイン実行 ---
@@ -640,8 +950,10 @@ def main():
         with st.sidebar:
             st.write(f"User: {st.session_state.get('user_name')}")
             if st.button("ログアウト"):
-                st.session_state.clear()
-                st.rerun()
+                # 退勤などの保存失敗を見逃さないよう、書き込みの完了を確認してからセッションを消す
+                if flush_pending_writes():
+                    st.session_state.clear()
+                    st.rerun()
 
     if not st.session_state['logged_in']:
         login_screen()